@@ -20,7 +20,12 @@ Actions:
     -L num      List the most recent [num] posts.
     -N          Posting a new blog. The entry, in the Movable Type
                 import/export format, is read from the standard input.
-    -P postid   List out trackback pings to this post.
+    -P postid   List out trackback pings to this post. Several post IDs can be
+                separated by commas. If the value is '-', pings to all the
+                recent posts are listed, or to the [num] most recent posts
+                if it is '-num'. Pings of several posts are deduplicated and
+                printed as they arrive, followed by the number of pings from
+                each IP address and domain.
     -R postid   Rebuild all the static files related to this entry.
     -T          List out the text filters installed on the server.
     -U filename Upload a file, reading from standard input, to the blog site,
@@ -33,7 +38,12 @@ Options:
                 relavent site URL/username/password information using this
                 alias.
     -c config   Load "config" as configuration file, instead of the default.
+                It can be given more than once; options in later files
+                override those in earlier ones.
     -h          Display this help message.
+    -j num      Send up to [num] requests to a site at the same time. The
+                number actually used adapts to how fast the site answers
+                and how often it fails. Default is 16.
     -q          Decrease verbose level.
     -v          Increase verbose level. Message goes to standard error.
 
@@ -46,26 +56,520 @@ __copyright__   = 'Copyright (c) 2002-2005 Scott Yang'
 __date__        = '2005-11-19'
 __version__     = '1.1'
 
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import http.client
 import os
 import platform
 import re
 import sys
+import threading
 import time
 import urllib.parse
+import urllib.request
+import xml.parsers.expat
 import xmlrpc.client
 
 
+Blog = collections.namedtuple('Blog', 'blogid name url')
+Category = collections.namedtuple('Category', 'categoryid name')
+Ping = collections.namedtuple('Ping', 'title url ip')
+TextFilter = collections.namedtuple('TextFilter', 'key label')
+
+
+BlogConfig = collections.namedtuple('BlogConfig', 'alias blogid site')
+SiteConfig = collections.namedtuple('SiteConfig',
+    'name url username password encoding')
+
+
+class Config(object):
+    """Read-only, precompiled view of the configuration files.
+
+    All [site-*] and [blog-*] sections are resolved once into SiteConfig and
+    BlogConfig records, so looking up a blog is a dictionary access and
+    configparser is not consulted for every request. Options missing from
+    the files are None. Use load_config() to get one, which also takes care
+    of includes, environment overrides and reloading.
+
+        config = load_config('/home/scotty/.mtsendrc')
+        print(config.blog('example').site.url)
+
+    """
+
+    def __init__(self, parser, files=()):
+        self.files = tuple(files)
+
+        try:
+            self.default = parser.get('global', 'default')
+        except configparser.Error:
+            self.default = None
+
+        self._sites = {}
+        for section in parser.sections():
+            if section.startswith('site-'):
+                name = section[5:]
+                self._sites[name] = SiteConfig(name,
+                    parser.get(section, 'url', fallback=None),
+                    parser.get(section, 'username', fallback=None),
+                    parser.get(section, 'password', fallback=None),
+                    parser.get(section, 'encoding', fallback='UTF-8'))
+
+        self._blogs = {}
+        for section in parser.sections():
+            if section.startswith('blog-'):
+                alias = section[5:]
+                site = parser.get(section, 'site', fallback=None)
+                self._blogs[alias] = BlogConfig(alias,
+                    parser.get(section, 'blogid', fallback=None),
+                    self._sites.get(site, site))
+
+    def blog(self, alias=None):
+        if alias is None:
+            alias = self.default
+            if alias is None:
+                raise Exception('Blog alias has not been specified.')
+
+        try:
+            blog = self._blogs[alias]
+        except KeyError:
+            raise Exception('Blog "%s" is not in the configuration file.' % \
+                alias)
+
+        if blog.site is None:
+            raise Exception('Site of blog "%s" has not been specified.' % \
+                alias)
+        elif not isinstance(blog.site, SiteConfig):
+            raise Exception('Site "%s" of blog "%s" is not in the '
+                'configuration file.' % (blog.site, alias))
+
+        return blog
+
+    def is_stale(self):
+        for path, mtime in self.files:
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                if mtime is not None:
+                    return True
+
+        return False
+
+    def site(self, name):
+        try:
+            return self._sites[name]
+        except KeyError:
+            raise Exception('Site "%s" is not in the configuration file.' % \
+                name)
+
+
+class MTSendClient(object):
+    """Thread-safe XML-RPC client for the blogs in a configuration file.
+
+    Unlike MTSend, which prints whatever it retrieves, every method here
+    returns its result, and the blog alias is passed with each call instead
+    of being kept on the instance. A single client can therefore be shared
+    between threads. XML-RPC connections are pooled per site, category lists
+    are cached per blog, and the number of requests sent to each site at
+    once is adapted by a SiteScheduler, e.g.
+
+        client = MTSendClient('/home/scotty/.mtsendrc')
+        for post in client.get_recent_posts(5, 'example'):
+            print(post['title'])
+
+    """
+
+    def __init__(self, config, log=None, maxconns=16, retries=3):
+        # Given file names, the configuration is reloaded whenever one of
+        # the files changes.
+        if isinstance(config, configparser.RawConfigParser):
+            self._config = Config(config)
+        elif isinstance(config, Config):
+            self._config = config
+        else:
+            self._config = None
+            self._paths = config
+
+        self.maxconns = maxconns
+        self.retries = retries
+        self._log = log
+        self.scheduler = SiteScheduler(self.log, maximum=maxconns)
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._categories = {}
+
+    def add_category(self, name, alias=None):
+        blog = self.get_config().blog(alias)
+        catid = self._call(blog.site, 'wp.newCategory',
+            self._getOption(blog, 'blogid'), *self._getAuth(blog.site),
+            {'name': name})
+
+        self._forgetCategories(blog)
+        return catid
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for record, servers in idle.values():
+            for srv in servers:
+                srv('close')()
+
+    def delete_category(self, catid, alias=None):
+        blog = self.get_config().blog(alias)
+        self._call(blog.site, 'wp.deleteCategory',
+            int(self._getOption(blog, 'blogid')), *self._getAuth(blog.site),
+            int(catid))
+
+        self._forgetCategories(blog)
+
+    def delete_post(self, postid, alias=None):
+        blog = self.get_config().blog(alias)
+        self._call(blog.site, 'blogger.deletePost', 'mtsend', postid,
+            *self._getAuth(blog.site), True)
+
+    def edit_post(self, postid, post, cts=(), publish=False, alias=None):
+        blog = self.get_config().blog(alias)
+        self.log(1, 'Saving post entry "%s"...', postid)
+        self._call(blog.site, 'metaWeblog.editPost', postid,
+            *self._getAuth(blog.site), post, xmlrpc.client.Boolean(publish))
+
+        self._setPostCategories(blog, postid, cts)
+
+    def get_blogs(self, site):
+        site = self.get_config().site(site)
+        blogs = self._call(site, 'blogger.getUsersBlogs', '',
+            *self._getAuth(site))
+
+        return [Blog(blog['blogid'], blog['blogName'], blog['url'])
+                for blog in blogs]
+
+    def get_categories(self, alias=None):
+        return self._getCategories(self.get_config().blog(alias))
+
+    def get_post(self, postid, alias=None):
+        blog = self.get_config().blog(alias)
+        self.log(1, 'Retrieve post entry "%s"...', postid)
+        return self._call(blog.site, 'metaWeblog.getPost', postid,
+            *self._getAuth(blog.site))
+
+    def get_post_categories(self, postid, alias=None):
+        blog = self.get_config().blog(alias)
+        self.log(1, 'Retrieve categories for post entry "%s"...', postid)
+        return self._call(blog.site, 'mt.getPostCategories', str(postid),
+            *self._getAuth(blog.site))
+
+    def get_recent_posts(self, num=0, alias=None):
+        blog = self.get_config().blog(alias)
+        posts = self._call(blog.site, 'metaWeblog.getRecentPosts',
+            str(self._getOption(blog, 'blogid')), *self._getAuth(blog.site),
+            num)
+
+        self.log(1, 'Retrieve "%d" recent posts...', len(posts))
+        return posts
+
+    def get_recent_postids(self, num=0, alias=None):
+        # mt.getRecentPostTitles leaves out the post bodies, which matters
+        # when all the posts of a blog are listed.
+        blog = self.get_config().blog(alias)
+        posts = self._call(blog.site, 'mt.getRecentPostTitles',
+            str(self._getOption(blog, 'blogid')), *self._getAuth(blog.site),
+            num)
+
+        self.log(1, 'Retrieve "%d" recent post IDs...', len(posts))
+        return [post['postid'] for post in posts]
+
+    def get_text_filters(self, alias=None):
+        blog = self.get_config().blog(alias)
+        filters = self._call(blog.site, 'mt.supportedTextFilters')
+
+        return sorted([TextFilter(val['key'], val['label'])
+                       for val in filters])
+
+    def get_trackback_pings(self, postid, alias=None):
+        return self._getTrackbackPings(self.get_config().blog(alias), postid)
+
+    def get_blogid(self, alias=None):
+        return self._getOption(self.get_config().blog(alias), 'blogid')
+
+    def get_password(self, site):
+        return self._getOption(self.get_config().site(site), 'password')
+
+    def get_config(self):
+        if self._config is not None:
+            return self._config
+        return load_config(self._paths)
+
+    def get_site(self, alias=None):
+        return self.get_config().blog(alias).site.name
+
+    def get_username(self, site):
+        return self._getOption(self.get_config().site(site), 'username')
+
+    def iter_trackback_pings(self, postids, alias=None, workers=None):
+        """Retrieve the trackback pings of many posts concurrently.
+
+        Yields (postid, pings) pairs in the order the responses arrive. Only
+        a few requests per worker are queued at a time, so postids can be a
+        long iterator. Posts that fail, with a fault or an HTTP or network
+        error, are logged and yielded with None instead of their pings, so
+        that one bad post does not end the run. There are maxconns workers
+        by default; how many of them actually talk to the site at once is
+        left to the scheduler.
+
+        """
+        if workers is None:
+            workers = self.maxconns
+
+        blog = self.get_config().blog(alias)
+        postids = iter(postids)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            pending = set()
+            for postid in postids:
+                pending.add(executor.submit(self._getPostPings, blog,
+                    postid))
+                if len(pending) >= workers * 2:
+                    done, pending = concurrent.futures.wait(pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+
+            for future in concurrent.futures.as_completed(pending):
+                yield future.result()
+
+    def log(self, level, msg, *fmt):
+        if self._log is not None:
+            self._log(level, msg, *fmt)
+
+    def new_post(self, post, cts=(), publish=False, alias=None):
+        blog = self.get_config().blog(alias)
+        self.log(1, 'Saving new post entry...')
+        postid = self._call(blog.site, 'metaWeblog.newPost',
+            self._getOption(blog, 'blogid'), *self._getAuth(blog.site), post,
+            xmlrpc.client.Boolean(publish))
+
+        self._setPostCategories(blog, postid, cts)
+        return postid
+
+    def publish_post(self, postid, alias=None):
+        blog = self.get_config().blog(alias)
+        self._call(blog.site, 'mt.publishPost', postid,
+            *self._getAuth(blog.site))
+
+    def set_post_categories(self, postid, cts, alias=None):
+        self._setPostCategories(self.get_config().blog(alias), postid, cts)
+
+    def upload_file(self, name, bits, alias=None):
+        blog = self.get_config().blog(alias)
+        self.log(1, 'Uploading "%s" (%d bytes)...', name, len(bits))
+        media_object = {
+            'name': name,
+            'bits': xmlrpc.client.Binary(bits),
+        }
+
+        result = self._call(blog.site, 'metaWeblog.newMediaObject',
+            self._getOption(blog, 'blogid'), *self._getAuth(blog.site),
+            media_object)
+
+        return result['url']
+
+    def _call(self, site, method, *args):
+        # Every request goes through the scheduler, which decides how many
+        # may be in flight to the site and learns from how each one went. A
+        # request refused with Retry-After is sent again once the site has
+        # asked us to wait, up to self.retries times. site is the SiteConfig
+        # record resolved by the caller, so that one request never mixes
+        # options from two versions of the configuration.
+        attempt = 0
+        while True:
+            start = self.scheduler.acquire(site.name)
+            try:
+                with self._server(site) as srv:
+                    result = getattr(srv, method)(*args)
+            except xmlrpc.client.ProtocolError as ex:
+                delay = None
+                if ex.errcode in (429, 503):
+                    for key, val in (ex.headers or {}).items():
+                        if key.lower() == 'retry-after':
+                            delay = parse_retry_after(val)
+                self.scheduler.release(site.name, start, True, delay)
+
+                if (delay is None) or (attempt >= self.retries):
+                    raise
+                attempt += 1
+                self.log(1, 'Site "%s" is busy, retrying %s in %d seconds...',
+                    site.name, method, delay)
+            except:
+                self.scheduler.release(site.name, start, True)
+                raise
+            else:
+                self.scheduler.release(site.name, start)
+                return result
+
+    def _fixCategories(self, blog, cts):
+        if len(cts) == 0:
+            return []
+
+        # The list is cached with the blog record it was fetched for, so a
+        # reload that points the alias at another blog or site drops it.
+        with self._lock:
+            record, old = self._categories.get(blog.alias, (None, None))
+            if record != blog:
+                old = None
+
+        cached = old is not None
+        if not cached:
+            self.log(1, 'Retrieve available categories...')
+            old = self._getCategories(blog)
+
+        ctsmap = {}
+        for cat in old:
+            ctsmap[cat.name.lower()] = cat.categoryid
+
+        if cached and [cat for cat in cts if cat not in ctsmap]:
+            # The category may have been created elsewhere since the list
+            # was cached, so fetch it again before giving up on the name.
+            self.log(1, 'Retrieve available categories...')
+            ctsmap = {}
+            for cat in self._getCategories(blog):
+                ctsmap[cat.name.lower()] = cat.categoryid
+
+        new = []
+        seen = set()
+        for cat in cts:
+            if cat in seen:
+                continue
+            seen.add(cat)
+
+            try:
+                new.append({'categoryId': ctsmap[cat]})
+            except KeyError:
+                self.log(1, 'Category "%s" does not exist, ignored.', cat)
+
+        return new
+
+    def _forgetCategories(self, blog):
+        with self._lock:
+            self._categories.pop(blog.alias, None)
+
+    def _getAuth(self, site):
+        return (self._getOption(site, 'username'),
+                self._getOption(site, 'password'))
+
+    def _getCategories(self, blog):
+        cts = self._call(blog.site, 'mt.getCategoryList',
+            self._getOption(blog, 'blogid'), *self._getAuth(blog.site))
+
+        result = [Category(cat['categoryId'], cat['categoryName'])
+                  for cat in cts]
+
+        with self._lock:
+            self._categories[blog.alias] = (blog, result)
+        return result
+
+    def _getOption(self, record, option):
+        value = getattr(record, option)
+        if value is None:
+            raise KeyError(option)
+        return value
+
+    def _getPostPings(self, blog, postid):
+        try:
+            return postid, self._getTrackbackPings(blog, postid)
+        except xmlrpc.client.Fault as ex:
+            self.log(1, 'Cannot retrieve pings to post entry "%s": %s',
+                postid, ex.faultString)
+        except (xmlrpc.client.ProtocolError, xmlrpc.client.ResponseError,
+                http.client.HTTPException, xml.parsers.expat.ExpatError,
+                OSError) as ex:
+            # A truncated or malformed response, or a network error, only
+            # loses this post.
+            self.log(1, 'Cannot retrieve pings to post entry "%s": %s',
+                postid, ex)
+
+        return postid, None
+
+    def _getTrackbackPings(self, blog, postid):
+        pings = self._call(blog.site, 'mt.getTrackbackPings', postid)
+
+        return [Ping(val['pingTitle'], val['pingURL'], val['pingIP'])
+                for val in pings]
+
+    def _newServer(self, site):
+        url = self._getOption(site, 'url')
+        transport = get_rpc_transport(url)
+
+        # Default we will use 'UTF-8' encoding, if the site encoding option is
+        # not provided.
+        return xmlrpc.client.ServerProxy(url, transport, site.encoding)
+
+    def _setPostCategories(self, blog, postid, cts):
+        # Category names are translated into IDs with the cached category
+        # list, so that a batch of posts only fetches it once.
+        cts = self._fixCategories(blog, cts)
+        if len(cts) > 0:
+            self.log(1, 'Add categories "%s" to post entry "%s"...',
+                ','.join([str(cat['categoryId']) for cat in cts]), postid)
+            self._call(blog.site, 'mt.setPostCategories', postid,
+                *self._getAuth(blog.site), cts)
+
+    @contextlib.contextmanager
+    def _server(self, site):
+        # Borrow an idle ServerProxy of this site from the pool. Its
+        # transport keeps the HTTP connection alive, but it cannot be used by
+        # two threads at once, so each thread gets its own while it is out.
+        # The pool of each site remembers the site record its connections
+        # were made with. When the configuration changes the record, they
+        # are closed rather than reused with the old URL or credentials.
+        stale = []
+        with self._lock:
+            old, idle = self._idle.get(site.name, (None, []))
+            if old != site:
+                stale = idle
+                idle = []
+                self._idle[site.name] = (site, idle)
+            srv = idle.pop() if idle else None
+
+        for old in stale:
+            old('close')()
+
+        if srv is None:
+            srv = self._newServer(site)
+
+        reuse = False
+        try:
+            yield srv
+            reuse = True
+        except xmlrpc.client.Fault:
+            # A fault is a proper XML-RPC response, so the connection is
+            # still in a good state.
+            reuse = True
+            raise
+        finally:
+            with self._lock:
+                old, idle = self._idle.get(site.name, (None, []))
+                if reuse and (old == site) and \
+                        (len(idle) < self.maxconns):
+                    idle.append(srv)
+                    srv = None
+
+            if srv is not None:
+                srv('close')()
+
+
+
 class MTSend(object):
     def __init__(self):
         self.alias = None
         self.input = None
+        self.client = None
         self.config = None
         self.mode = None
         self.verbose = 1
-        self.rpcsrv = None
-        self.site = None
         self.modeopt = None
+        self.workers = 16
 
     def execute(self):
         try:
@@ -76,33 +580,23 @@ class MTSend(object):
             handler()
 
     def execute_a(self):
-        srv = self.getRPCServer()
-        srv.wp.newCategory(self.get_blogid(), self.get_username(), self.get_password(), {'name': self.modeopt})
+        self.getClient().add_category(self.modeopt, self.alias)
 
     def execute_b(self):
-        self.site = self.modeopt
-        srv = self.getRPCServer()
-        blogs = srv.blogger.getUsersBlogs('', self.get_username(), 
-            self.get_password())
         result = [['ID', 'Blog Name', 'URL']]
-        for blog in blogs:
-            result.append([blog['blogid'], blog['blogName'], blog['url']])
+        for blog in self.getClient().get_blogs(self.modeopt):
+            result.append([blog.blogid, blog.name, blog.url])
         print_table(result)
 
     def execute_c(self):
-        srv = self.getRPCServer()
-        cts = srv.mt.getCategoryList(self.get_blogid(), self.get_username(), 
-            self.get_password())
         result = []
-        for cat in cts:
-            result.append([cat['categoryId'], cat['categoryName']])
-        sorted(result)
+        for cat in self.getClient().get_categories(self.alias):
+            result.append([cat.categoryid, cat.name])
         result[0:0] = [['ID', 'Category Name']]
         print_table(result)
 
     def execute_d(self):
-        srv = self.getRPCServer()
-        srv.wp.deleteCategory(int(self.get_blogid()), self.get_username(), self.get_password(), int(self.modeopt))
+        self.getClient().delete_category(self.modeopt, self.alias)
 
     def execute_e(self):
         self.log(1, 'Parsing post entry from standard input...')
@@ -119,58 +613,36 @@ class MTSend(object):
             raise Exception('Post ID does not match. ID in the input is "%s"' % \
                     post['postid'])
 
-        srv = self.getRPCServer()
-        self.log(1, 'Saving post entry "%s"...', postid)
-        srv.metaWeblog.editPost(postid, self.get_username(), 
-            self.get_password(), post, publish)
-
-        cts = self._fixCategories(cts)
-        if len(cts) > 0:
-            self.log(1, 'Add categories "%s" to post entry "%s"...',
-                ','.join([cat['categoryId'] for cat in cts]), postid)
-            srv.mt.setPostCategories(postid, self.get_username(),
-                self.get_password(), cts)
+        self.getClient().edit_post(postid, post, cts, publish, self.alias)
 
     def execute_g(self):
-        srv = self.getRPCServer()
+        client = self.getClient()
         if self.modeopt.lower() == '-':
             self.log(1, 'Retrieve most recent post entry...')
-            post = srv.metaWeblog.getRecentPosts(str(self.get_blogid()), 
-                self.get_username(), self.get_password(), 1)
+            post = client.get_recent_posts(1, self.alias)
             if len(post) > 0:
                 post = post[0]
             else:
                 raise Exception('The current blog does not have any entry.')
         else:
-            self.log(1, 'Retrieve post entry "%s"...', self.modeopt)
-            post = srv.metaWeblog.getPost\
-                ( self.modeopt, self.get_username(), self.get_password() )
+            post = client.get_post(self.modeopt, self.alias)
 
         # Get the categories of this post.
-        self.log(1, 'Retrieve categories for post entry "%s"...', 
-                 post['postid'])
-        cts = srv.mt.getPostCategories(str(post['postid']), self.get_username(), 
-            self.get_password())
+        cts = client.get_post_categories(post['postid'], self.alias)
 
         print_post(post, cts)
 
     def execute_l(self):
-        srv = self.getRPCServer()
         try:
             num = int(self.modeopt)
         except:
             num = 0
 
-        posts = srv.metaWeblog.getRecentPosts(self.get_blogid(), self.get_username(), 
-            self.get_password(), num)
-        num = len(posts)
-
-        self.log(1, 'Retrieve "%d" recent posts...', num)
         result = [['ID', 'Date', 'Title']]
-        for post in posts:
+        for post in self.getClient().get_recent_posts(num, self.alias):
             result.append([
                 post['postid'],
-                time.strftime('%Y-%m-%d %H:%M:%S', 
+                time.strftime('%Y-%m-%d %H:%M:%S',
                     decode_iso8601(post['dateCreated'])),
                 post['title']
             ])
@@ -180,86 +652,75 @@ class MTSend(object):
     def execute_n(self):
         self.log(1, 'Parsing post entry from standard input...')
         post, cts, publish = parse_post()
-        srv = self.getRPCServer()
 
-        self.log(1, 'Saving new post entry...')
-        postid = srv.metaWeblog.newPost(self.get_blogid(), self.get_username(), 
-            self.get_password(), post, publish)
+        print(self.getClient().new_post(post, cts, publish, self.alias))
 
-        cts = self._fixCategories(cts)
-        if len(cts) > 0:
-            self.log(1, 'Add categories "%s" to post entry "%s"...',
-                     ','.join([cat['categoryId'] for cat in cts]), postid)
-            srv.mt.setPostCategories(postid, self.get_username(), 
-                self.get_password(), cts)
+    def execute_p(self):
+        client = self.getClient()
+        if self.modeopt.startswith('-'):
+            try:
+                num = int(self.modeopt[1:] or 0)
+            except ValueError:
+                raise Exception('Invalid number of posts: %s' % \
+                    self.modeopt[1:])
+            postids = client.get_recent_postids(num, self.alias)
 
-        print(postid)
+        elif ',' in self.modeopt:
+            postids = [postid.strip() for postid in self.modeopt.split(',')
+                       if postid.strip()]
 
-    def execute_p(self):
-        srv = self.getRPCServer()
-        result = [[
-            val['pingTitle'],
-            val['pingURL'],
-            val['pingIP'],
-        ] for val in srv.mt.getTrackbackPings(self.modeopt)]
-
-        result.insert(0, ['Title', 'URL', 'IP'])
-        print_table(result)
+        else:
+            result = [[
+                ping.title,
+                ping.url,
+                ping.ip,
+            ] for ping in client.get_trackback_pings(self.modeopt,
+                self.alias)]
+
+            result.insert(0, ['Title', 'URL', 'IP'])
+            print_table(result)
+            return
+
+        # Print every new ping as soon as it arrives, rather than waiting for
+        # the whole table, so that long audits can be followed or piped.
+        report = PingReport()
+        for postid, pings in client.iter_trackback_pings(postids, self.alias):
+            for ping in report.add(pings):
+                print('\t'.join([str(postid), ping.ip, ping.url, ping.title]),
+                      flush=True)
+
+        self.log(1, 'Found %d pings (%d unique) to %d posts, '
+            '%d posts failed.', report.total, len(report.seen), report.posts,
+            report.failures)
+
+        for title, counter in (('IP', report.ips), ('Domain', report.domains)):
+            result = [[key, count] for key, count in counter.most_common()]
+            result.insert(0, [title, 'Pings'])
+            print_table(result)
 
     def execute_r(self):
-        srv = self.getRPCServer()
-        srv.mt.publishPost(self.modeopt, self.get_username(), 
-            self.get_password())
+        self.getClient().publish_post(self.modeopt, self.alias)
 
     def execute_t(self):
-        srv = self.getRPCServer()
-        result = []
-        for val in srv.mt.supportedTextFilters():
-            result.append([val['key'], val['label']])
-
-        result.sort()
+        result = [[val.key, val.label]
+                  for val in self.getClient().get_text_filters(self.alias)]
         result.insert(0, ['Key', 'Label'])
         print_table(result)
 
     def execute_u(self):
-        srv = self.getRPCServer()
-        bin = sys.stdin.read()
-
-        self.log(1, 'Uploading "%s" (%d bytes)...', self.modeopt, len(bin))
-        media_object = {
-            'name': self.modeopt,
-            'bits': xmlrpc.client.Binary(bin),
-        }
-
-        result = srv.metaWeblog.newMediaObject(self.get_blogid(), 
-            self.get_username(), self.get_password(), media_object)
-
-        print(result['url'])
+        bits = sys.stdin.buffer.read()
+        print(self.getClient().upload_file(self.modeopt, bits, self.alias))
 
     def execute_x(self):
-        srv = self.getRPCServer()
-        srv.blogger.deletePost('mtsend', self.modeopt, self.get_username(), self.get_password(), True)
-
-    def getRPCServer(self):
-        if self.rpcsrv is not None:
-            return self.rpcsrv
-
-        httptype = urllib.parse.splittype(self._getSite('url'))[0]
-        transport = get_rpc_transport(httptype)
+        self.getClient().delete_post(self.modeopt, self.alias)
 
-        # Default we will use 'UTF-8' encoding, if the site encoding option is
-        # not provided.
-        return xmlrpc.client.ServerProxy(self._getSite('url'), transport,
-            self._getSite('encoding', 'UTF-8'))
-
-    def get_blogid(self):
-        return self._getBlog('blogid')
+    def getClient(self):
+        if self.client is None:
+            if self.config is None:
+                raise Exception('Configuration has not been loaded.')
+            self.client = MTSendClient(self.config, self.log, self.workers)
 
-    def get_password(self):
-        return self._getSite('password')
-
-    def get_username(self):
-        return self._getSite('username')
+        return self.client
 
     def getConfigFile(self):
         try:
@@ -301,8 +762,8 @@ class MTSend(object):
         if config is None:
             config = self.getConfigFile()
 
-        self.config = configparser.ConfigParser()
-        self.config.read([config])
+        self.config = load_config(config)
+        self.client = None
 
     def log(self, level, msg, *fmt):
         if self.verbose >= level:
@@ -315,72 +776,6 @@ class MTSend(object):
         else:
             raise Exception('Conflicting operational mode.')
 
-    def _fixCategories(self, cts):
-        if len(cts) > 0:
-            srv = self.getRPCServer()
-            new = []
-
-            self.log(1, 'Retrieve available categories...')
-            old = srv.mt.getCategoryList(self.get_blogid(), 
-                self.get_username(), self.get_password())
-            ctsmap = {}
-            for cat in old:
-                ctsmap[cat['categoryName'].lower()] = cat['categoryId']
-
-            for cat in cts:
-                try:
-                    new.append({'categoryId': ctsmap[cat]})
-                    del ctsmap[cat]
-                except KeyError:
-                    pass
-
-            return new
-        else:
-            return []
-
-    def _getBlog(self, option, default=None):
-        if self.config is None:
-            raise Exception('Configuration has not been loaded.')
-
-        if self.alias is None:
-            try:
-                alias = self._getGlobal('default')
-            except KeyError:
-                raise Exception('Blog alias has not been specified.')
-        else:
-            alias = self.alias
-
-        try:
-            return self.config.get('blog-%s' % alias, option)
-        except configparser.Error:
-            if default is not None:
-                return default
-            else:
-                raise KeyError(option)
-
-    def _getGlobal(self, option, default=None):
-        if self.config is None:
-            raise Exception('Configuration has not been loaded.')
-        try:
-            return self.config.get('global', option)
-        except configparser.Error:
-            if default is not None:
-                return default
-            else:
-                raise KeyError(option)
-
-    def _getSite(self, option, default=None):
-        try:
-            if self.site is None:
-                self.site = self._getBlog('site')
-
-            return self.config.get('site-%s' % self.site, option)
-        except (configparser.Error, KeyError):
-            if default is not None:
-                return default
-            else:
-                raise KeyError(option)
-
 
     class ProxyTransport(xmlrpc.client.Transport):
         """Transport class for the XMLRPC.
@@ -392,31 +787,40 @@ class MTSend(object):
 
             transport = ProxyTransport('proxy.mydomain.com', 3128)
             server = Server("http://betty.userland.com", transport)
-            print server.examples.getStateName(41)
+            print(server.examples.getStateName(41))
+
+        Plain HTTP requests are sent to the proxy with the absolute URL. For
+        HTTPS, a CONNECT tunnel is opened through the proxy and TLS runs
+        inside it. The tunnel is kept alive like any other HTTP/1.1
+        connection, so later requests to the same host reuse both the tunnel
+        and the TLS session.
 
         """
 
         def __init__(self, host, port=3128, username=None, password=None, 
-                ssl=False):
+                ssl=False, context=None):
+            xmlrpc.client.Transport.__init__(self, use_datetime=True,
+                use_builtin_types=True)
             self.__host = host
             self.__port = port
             self.__username = username
             self.__password = password
             self.__ssl = ssl
-            self.__target_host = None
-            self._connection = (None, None)
-            self._extra_headers = []
-            self._use_builtin_types = True
-            self._use_datetime = True
+            self.__context = context
             self.user_agent = "Mozilla/5.0 (X11; %s %s) Firefox/%s mtsend.py/%s" % (platform.system(), platform.machine(), platform.python_version(),  __version__)
 
 
         def get_authentication(self):
             import base64
-            auth_token = '%s:%s' % (self.__username, self.__password)
-            auth_token = base64.encodestring(urllib.parse.unquote(auth_token))
-            auth_token = auth_token.strip()
-            return 'Basic '+auth_token
+            auth_token = '%s:%s' % (urllib.parse.unquote(self.__username),
+                urllib.parse.unquote(self.__password))
+            auth_token = base64.b64encode(auth_token.encode('utf-8'))
+            return 'Basic ' + auth_token.decode('ascii')
+
+
+        def has_authentication(self):
+            return (self.__username is not None) and \
+                (self.__password is not None)
 
 
         def send_content(self, connection, request_body):
@@ -424,10 +828,12 @@ class MTSend(object):
 
             This method override the default send_content. If the proxy
             username and password has been configured, then we will place an
-            extra header here so the connection can be authenticated.
+            extra header here so the connection can be authenticated. It is
+            not needed inside a CONNECT tunnel, where the proxy has already
+            seen the credentials and the header would go to the target host.
 
             """
-            if (self.__username is not None) and (self.__password is not None):
+            if (not self.__ssl) and self.has_authentication():
                 connection.putheader("Proxy-Authorization", 
                     self.get_authentication())
 
@@ -436,22 +842,179 @@ class MTSend(object):
 
         def send_request(self, host, handler, request_body, debug):
             if not self.__ssl:
-                prot = "http://"
-            else:
-                prot = "https://"
+                # The proxy needs the absolute URL to know where to forward
+                # the request.
+                handler = "http://" + self.get_host_info(host)[0] + handler
 
-            handler = prot + host + handler
-            return xmlrpc.client.Transport.send_request(self, self.__host, handler, request_body, debug)
+            return xmlrpc.client.Transport.send_request(self, host, handler,
+                request_body, debug)
 
         def make_connection(self, host):
             "Make a connection to the proxy server"
 
             # Note that we will try to connect to the proxy server instead of
-            # our target host. It also needs to store the information about
-            # the target host so that we can use that information in
-            # send_request() call.
+            # our target host. The connection is cached against the target
+            # host, so the keep-alive handling of xmlrpc.client.Transport
+            # applies to the proxy connection or tunnel as well.
+
+            if self._connection and host == self._connection[0]:
+                return self._connection[1]
+
+            chost, self._extra_headers, x509 = self.get_host_info(host)
+            if self.__ssl:
+                if self.__context is None:
+                    import ssl
+                    self.__context = ssl.create_default_context()
+
+                connection = http.client.HTTPSConnection(self.__host,
+                    self.__port, context=self.__context)
+
+                headers = {}
+                if self.has_authentication():
+                    headers['Proxy-Authorization'] = self.get_authentication()
+                connection.set_tunnel(chost, headers=headers)
+            else:
+                connection = http.client.HTTPConnection(self.__host,
+                    self.__port)
+
+            self._connection = host, connection
+            return connection
+
+class PingReport(object):
+    """Deduplicates trackback pings and counts them per IP and domain.
+
+    Pings are the same if they have the same URL and IP address. The counts
+    include the duplicates, as repeated pings are what spam looks like.
+    Posts whose pings could not be retrieved are added as None and only
+    counted in failures.
+
+    """
+
+    def __init__(self):
+        self.domains = collections.Counter()
+        self.failures = 0
+        self.ips = collections.Counter()
+        self.posts = 0
+        self.seen = set()
+        self.total = 0
+
+    def add(self, pings):
+        """Add the pings of one post, returning those not seen before."""
+        if pings is None:
+            self.failures += 1
+            return []
+
+        new = []
+        self.posts += 1
+        for ping in pings:
+            self.total += 1
+            self.ips[ping.ip] += 1
+            try:
+                domain = urllib.parse.urlsplit(ping.url).hostname
+            except ValueError:
+                domain = None
+            self.domains[domain or ping.url] += 1
+
+            key = (ping.url, ping.ip)
+            if key not in self.seen:
+                self.seen.add(key)
+                new.append(ping)
+
+        return new
+
+
+class SiteScheduler(object):
+    """Adapts the number of requests in flight to each site.
+
+    Every site starts with a limit of initial requests at once. Each request
+    that succeeds without being much slower than the recent average raises
+    the limit by about one per round of requests, up to maximum. An error, a
+    fault, or a request taking more than twice the average halves the limit,
+    but at most once per round, as the other requests of the same round
+    would only report the same trouble. A Retry-After delay stops all
+    requests to the site until it is over.
+
+        start = scheduler.acquire('test')
+        ...
+        scheduler.release('test', start, error)
+
+    """
+
+    def __init__(self, log=None, initial=2, maximum=16):
+        self.initial = initial
+        self.maximum = maximum
+        self._log = log
+        self._cond = threading.Condition()
+        self._sites = {}
+
+    def acquire(self, site):
+        """Wait until a request may be sent to site, returning its start."""
+        with self._cond:
+            state = self._getState(site)
+            while True:
+                delay = state['until'] - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                elif state['inflight'] >= int(state['limit']):
+                    self._cond.wait()
+                else:
+                    break
+
+            state['inflight'] += 1
+            return time.monotonic()
+
+    def get_limit(self, site):
+        with self._cond:
+            return int(self._getState(site)['limit'])
+
+    def release(self, site, start, error=False, retry_after=None):
+        """Record how a request started with acquire() went."""
+        now = time.monotonic()
+        latency = now - start
+
+        with self._cond:
+            state = self._getState(site)
+            state['inflight'] -= 1
+            old = int(state['limit'])
+            average = state['latency']
+
+            slow = (average is not None) and (latency > 2 * average)
+            if error or slow:
+                if now - state['decreased'] > (average or latency):
+                    state['limit'] = max(1.0, state['limit'] / 2)
+                    state['decreased'] = now
+            else:
+                state['limit'] = min(float(self.maximum),
+                    state['limit'] + 1.0 / state['limit'])
+
+            if average is None:
+                state['latency'] = latency
+            else:
+                state['latency'] = 0.8 * average + 0.2 * latency
+
+            if retry_after is not None:
+                state['until'] = max(state['until'], now + retry_after)
+
+            self._cond.notify_all()
+
+            if int(state['limit']) != old and self._log is not None:
+                self._log(2, 'Site "%s": up to %d requests at once '
+                    '(average latency %.3fs)', site, int(state['limit']),
+                    state['latency'])
+
+    def _getState(self, site):
+        try:
+            return self._sites[site]
+        except KeyError:
+            state = self._sites[site] = {
+                'decreased': 0.0,
+                'inflight': 0,
+                'latency': None,
+                'limit': float(min(self.initial, self.maximum)),
+                'until': 0.0,
+            }
+            return state
 
-            return xmlrpc.client.Transport.make_connection(self, "%s:%d" % (host, self.__port))
 
 def decode_iso8601(date):
     # Translate an ISO8601 date to the tuple format used in Python's time
@@ -467,13 +1030,26 @@ def decode_iso8601(date):
         return tuple(result)
 
 
-def get_rpc_transport(httptype):
-    # Detect whether we need to use 'ProxyTranspory'. Proxy detection is
-    # done using HTTP_PROXY or http_proxy environment variable.
-    proxy = os.environ.get('HTTP_PROXY') or os.environ.get('http_proxy')
+def get_rpc_transport(url):
+    # Detect whether we need to use 'ProxyTransport'. Proxy detection is
+    # done using HTTPS_PROXY (for https URLs) or HTTP_PROXY environment
+    # variables, in either case. Hosts listed in NO_PROXY are connected to
+    # directly.
+    parts = urllib.parse.urlsplit(url)
+    httptype = parts.scheme.lower()
+    if parts.hostname and \
+            urllib.request.proxy_bypass_environment(parts.hostname):
+        return None
+
+    proxy = None
+    if httptype == 'https':
+        proxy = os.environ.get('HTTPS_PROXY') or os.environ.get('https_proxy')
+    proxy = proxy or os.environ.get('HTTP_PROXY') or \
+        os.environ.get('http_proxy')
+
     if proxy:
-        match = re.match(r'^(http://)?(([^:@]+)(:([^@]*))?@)?([^:]+):(\d+)',
-            proxy)
+        match = re.match(r'^(https?://)?(([^:@]+)(:([^@]*))?@)?([^:/]+):(\d+)',
+            proxy, re.I)
 
         if match:
             username = match.group(3) or None
@@ -481,6 +1057,14 @@ def get_rpc_transport(httptype):
             hostname = match.group(6)
             bindport = int(match.group(7))
 
+            # ProxyTransport talks to the proxy in plain text, so refuse a
+            # proxy that expects TLS rather than send it the credentials
+            # unencrypted.
+            if (match.group(1) or '').lower() == 'https://':
+                raise Exception('Proxy %s:%d uses https, which is not '
+                    'supported. Use an http:// proxy URL.' % (hostname,
+                    bindport))
+
             return MTSend.ProxyTransport(hostname, bindport, username, password,
                 httptype=='https')
 
@@ -488,6 +1072,61 @@ def get_rpc_transport(httptype):
     return None
 
 
+_configs = {}
+_configs_lock = threading.Lock()
+
+# Options that can be overridden with MTSEND_<SECTION>_<OPTION> environment
+# variables, e.g. MTSEND_SITE_TEST_PASSWORD for [site-test] password.
+_config_options = {
+    'global': ('default',),
+    'blog': ('blogid', 'site'),
+    'site': ('encoding', 'password', 'url', 'username'),
+}
+
+def load_config(paths, check_interval=1.0):
+    """Return the Config compiled from paths, a file name or list of them.
+
+    Later files override earlier ones, as do the files named by the include
+    option of the [global] section over the file including them. Compiled
+    configurations are shared, and only compiled again when the mtime of one
+    of their files has changed, which is checked at most once every
+    check_interval seconds.
+
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    key = tuple([os.path.realpath(path) for path in paths])
+
+    now = time.monotonic()
+    with _configs_lock:
+        config, checked = _configs.get(key, (None, None))
+        if (config is not None) and (now - checked < check_interval):
+            return config
+
+    if (config is None) or config.is_stale():
+        parser = configparser.ConfigParser()
+        files = []
+        for path in key:
+            read_config(parser, path, files)
+
+        for section in ['global'] + parser.sections():
+            prefix = section.split('-', 1)[0]
+            for option in _config_options.get(prefix, ()):
+                name = 'MTSEND_%s_%s' % (re.sub(r'\W', '_', section).upper(),
+                    option.upper())
+                if name in os.environ:
+                    if not parser.has_section(section):
+                        parser.add_section(section)
+                    parser.set(section, option,
+                        os.environ[name].replace('%', '%%'))
+
+        config = Config(parser, files)
+
+    with _configs_lock:
+        _configs[key] = (config, now)
+    return config
+
+
 re_date = r'^(\d{2})/(\d{2})/(\d{4}) (\d{2}):(\d{2}):(\d{2})( ([AP]M))?$'
 re_date = re.compile(re_date).search
 
@@ -516,14 +1155,17 @@ def parse_date(val):
     return tuple(result)
 
 
-def parse_post():
+def parse_post(stream=None):
+    if stream is None:
+        stream = sys.stdin
+
     state = 0
     code = None
     post = {}
     cts = []
     publish = xmlrpc.client.Boolean(0)
 
-    for line in sys.stdin:
+    for line in stream:
         line = line.rstrip()
         if state == 0:
             if line == '-----':
@@ -595,6 +1237,23 @@ def parse_post():
     return post, cts, publish
 
 
+def parse_retry_after(val):
+    # Retry-After is either a number of seconds or an HTTP date.
+    if val is None:
+        return None
+    try:
+        return max(0, int(val))
+    except ValueError:
+        pass
+
+    import email.utils
+    try:
+        date = email.utils.parsedate_tz(val)
+        return max(0, int(email.utils.mktime_tz(date) - time.time()))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
 def print_post(post, cts):
     if 'title' in post:
         print('TITLE:', post['title'])
@@ -672,10 +1331,41 @@ def print_table(table):
     print(border)
 
 
+def read_config(parser, path, files):
+    # Read one configuration file into parser, after the files it includes,
+    # so that its own options take precedence. Every file read is added to
+    # files with its mtime, or None if it does not exist. Paths are
+    # normalised so that include loops are detected however they are
+    # spelled.
+    path = os.path.realpath(path)
+    if path in [name for name, mtime in files]:
+        return
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        files.append((path, None))
+        return
+    files.append((path, mtime))
+
+    own = configparser.ConfigParser()
+    own.read([path])
+    include = own.get('global', 'include', fallback='')
+    for name in re.split(r'[,\n]', include):
+        name = name.strip()
+        if name:
+            read_config(parser, os.path.realpath(os.path.join(
+                os.path.dirname(path), os.path.expanduser(name))), files)
+
+    parser.read([path])
+    if parser.has_option('global', 'include'):
+        parser.remove_option('global', 'include')
+
+
 def main(args):
     import getopt
     try:
-        opts, args = getopt.getopt(args, 'A:a:B:Cc:D:E:G:hL:NP:qR:TU:vVX:')
+        opts, args = getopt.getopt(args, 'A:a:B:Cc:D:E:G:hj:L:NP:qR:TU:vVX:')
     except getopt.GetoptError as ex:
         print('Error: '+str(ex), file=sys.stderr)
         print(__doc__, file=sys.stderr)
@@ -695,7 +1385,7 @@ def main(args):
             mtsend.setMode('c')
         elif opt == '-c':
             if os.access(arg, os.R_OK):
-                config = arg
+                config = (config or []) + [arg]
             else:
                 print(mtsend.getConfigFile(), file=sys.stderr)
                 sys.exit(0)
@@ -708,6 +1398,14 @@ def main(args):
         elif opt == '-h':
             print(__doc__, file=sys.stderr)
             sys.exit(0)
+        elif opt == '-j':
+            try:
+                mtsend.workers = int(arg)
+                assert(mtsend.workers > 0)
+            except (ValueError, AssertionError):
+                print('Error: Invalid number of requests: %s' % arg,
+                      file=sys.stderr)
+                sys.exit(1)
         elif opt == '-L':
             mtsend.setMode('l', arg)
         elif opt == '-N':